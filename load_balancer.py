@@ -1,15 +1,22 @@
 # Synapse - Load Balancer
 # This application acts as a reverse proxy and load balancer for the
 # backend LLM server nodes. It distributes requests in a round-robin
-# fashion and performs health checks to ensure requests are only sent
-# to healthy nodes.
+# fashion (or to the least busy node, see LB_POLICY) and performs health
+# checks to ensure requests are only sent to healthy nodes.
 
+import os
+import sys
+import logging
 import aiohttp
 import asyncio
-from itertools import cycle
+import uvicorn
+from synapse_logging import get_logger
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response # Use the standard, non-streaming Response
+from fastapi.responses import StreamingResponse
+from starlette.requests import ClientDisconnect
+from collections import defaultdict
 from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
 
 # --- Configuration ---
 BACKEND_SERVERS = [
@@ -17,113 +24,298 @@ BACKEND_SERVERS = [
     "http://localhost:8001",
     "http://localhost:8002",
 ]
-HEALTH_CHECK_INTERVAL = 10  # in seconds
+HEALTH_CHECK_INTERVAL = 10  # in seconds, used while the healthy set is changing
+HEALTH_CHECK_MAX_INTERVAL = 60  # in seconds, upper bound once the set is stable
+
+# Connection pool settings for the shared backend session. Raise these if the
+# pool becomes the bottleneck under load.
+CONNECTOR_LIMIT = 512  # total simultaneous connections
+CONNECTOR_LIMIT_PER_HOST = 128  # simultaneous connections per backend
+KEEPALIVE_TIMEOUT = 75  # in seconds
+DNS_CACHE_TTL = 600  # in seconds
+
+# Timeouts are built once and shared rather than re-created per request.
+PROXY_TIMEOUT = aiohttp.ClientTimeout(total=120.0, connect=5.0, sock_read=120.0)
+HEALTH_TIMEOUT = aiohttp.ClientTimeout(total=2.0)
+
+# Backend selection policy: "rr" cycles through healthy servers in turn;
+# "least" picks the server with the fewest requests in flight, which keeps
+# long generations from piling up behind each other on one node.
+LB_POLICY = os.environ.get("LB_POLICY", "rr").lower()
+if LB_POLICY not in ("rr", "least"):
+    raise ValueError(f"Unsupported LB_POLICY value: {LB_POLICY!r} (expected rr or least)")
+
+# Hop-by-hop headers apply to a single connection and must not be forwarded
+# by a proxy (RFC 7230, section 6.1). Host is rewritten by the client session.
+HOP_BY_HOP_HEADERS = frozenset({
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+})
+
+# Log verbosity. Per-request forwarding messages are logged at DEBUG, so they
+# are skipped entirely at the default level.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# --- Logging ---
+logger = get_logger("synapse.load_balancer", LOG_LEVEL)
 
 # --- Global Variables ---
-healthy_servers = []
-server_iterator = cycle(healthy_servers)
+# The healthy set is an immutable tuple that is swapped out wholesale when it
+# changes, so readers always see a consistent snapshot.
+healthy_servers = ()
+next_server_index = 0  # round-robin position into healthy_servers
+inflight_requests: Dict[str, int] = defaultdict(int)  # per-server requests in progress
 
 # --- Health Check Logic (using aiohttp) ---
-async def health_check_task():
+async def probe_server(session: aiohttp.ClientSession, server: str) -> Optional[str]:
+    """
+    Checks a single backend server. Returns the server URL if it is healthy,
+    or None if it is down or did not respond in time.
+    """
+    try:
+        async with session.get(f"{server}/health", timeout=HEALTH_TIMEOUT) as response:
+            if response.status == 200:
+                return server
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    return None
+
+async def check_servers(session: aiohttp.ClientSession) -> List[str]:
+    """
+    Probes all backend servers concurrently, so a slow node does not delay
+    the results for the others. Returns the healthy servers in
+    BACKEND_SERVERS order.
+    """
+    results = await asyncio.gather(
+        *[probe_server(session, server) for server in BACKEND_SERVERS],
+        return_exceptions=True,
+    )
+    return [result for result in results if isinstance(result, str)]
+
+async def health_check_task(session: aiohttp.ClientSession):
     """
     Periodically checks the health of the backend servers and updates
-    the list of healthy servers.
+    the list of healthy servers. Reuses the application's shared session
+    rather than opening a new one on every tick.
+
+    The interval doubles after each consecutive tick with no change, up to
+    HEALTH_CHECK_MAX_INTERVAL, and drops back to HEALTH_CHECK_INTERVAL as
+    soon as the healthy set changes.
     """
-    global healthy_servers, server_iterator
+    global healthy_servers
+    stable_count = 0
     while True:
-        currently_healthy = []
-        async with aiohttp.ClientSession() as session:
-            for server in BACKEND_SERVERS:
-                try:
-                    async with session.get(f"{server}/health", timeout=2) as response:
-                        if response.status == 200:
-                            currently_healthy.append(server)
-                except (aiohttp.ClientError, asyncio.TimeoutError):
-                    print(f"Server {server} is down.")
+        # check_servers preserves BACKEND_SERVERS order, so the tuple can be
+        # compared directly against the current snapshot.
+        currently_healthy = tuple(await check_servers(session))
 
-        if set(currently_healthy) != set(healthy_servers):
-            print(f"Healthy servers changed: {currently_healthy}")
-            healthy_servers.clear()
-            healthy_servers.extend(currently_healthy)
-            server_iterator = cycle(healthy_servers)
+        if currently_healthy != healthy_servers:
+            # Only report the servers whose state changed since the last tick.
+            for server in BACKEND_SERVERS:
+                if server in healthy_servers and server not in currently_healthy:
+                    logger.warning("Server %s is down.", server)
+                elif server in currently_healthy and server not in healthy_servers:
+                    logger.info("Server %s is back up.", server)
+            logger.info("Healthy servers changed: %s", list(currently_healthy))
+            healthy_servers = currently_healthy
+            stable_count = 0
+        else:
+            stable_count += 1
 
-        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        interval = min(
+            HEALTH_CHECK_MAX_INTERVAL,
+            HEALTH_CHECK_INTERVAL * (1 << min(stable_count, 3)),
+        )
+        await asyncio.sleep(interval)
 
 # --- Lifespan Event Handler ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    Handles startup events for the application.
-    Performs an initial health check and starts the background health check task.
-    """
-    print("--- Starting Synapse Load Balancer ---")
-    global healthy_servers, server_iterator
-    initially_healthy = []
-    async with aiohttp.ClientSession() as session:
-        for server in BACKEND_SERVERS:
-            try:
-                async with session.get(f"{server}/health", timeout=2) as response:
-                    if response.status == 200:
-                        initially_healthy.append(server)
-            except (aiohttp.ClientError, asyncio.TimeoutError):
-                pass
-    
-    healthy_servers.extend(initially_healthy)
-    server_iterator = cycle(healthy_servers)
-    print(f"Initial healthy servers: {healthy_servers}")
+    Handles startup and shutdown events for the application.
+    Creates the shared HTTP client session, performs an initial health check
+    and starts the background health check task.
+    """
+    logger.info("--- Starting Synapse Load Balancer ---")
+    global healthy_servers
+
+    # A single long-lived session lets every forwarded request reuse pooled,
+    # kept-alive connections to the backends instead of reconnecting each time.
+    session = aiohttp.ClientSession(
+        timeout=PROXY_TIMEOUT,
+        connector=aiohttp.TCPConnector(
+            limit=CONNECTOR_LIMIT,
+            limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            use_dns_cache=True,
+            force_close=False,
+        ),
+    )
+    app.state.client = session
 
-    asyncio.create_task(health_check_task())
+    healthy_servers = tuple(await check_servers(session))
+    logger.info("Initial healthy servers: %s", list(healthy_servers))
+
+    health_task = asyncio.create_task(health_check_task(session))
     
     yield
     
-    print("--- Shutting down Synapse Load Balancer ---")
+    logger.info("--- Shutting down Synapse Load Balancer ---")
+    health_task.cancel()
+    await session.close()
 
 # --- FastAPI Application ---
 app = FastAPI(title="Synapse - Load Balancer", lifespan=lifespan)
 
-# --- Final Proxy Logic (Standard Non-Streaming Proxy) ---
+# --- Local Endpoints ---
+@app.get("/health")
+async def health_check() -> Dict[str, str]:
+    """
+    Liveness check for the load balancer itself. Answered locally so health
+    probes are never forwarded to a backend.
+    """
+    return {"status": "ok"}
+
+# --- Backend Selection ---
+def select_server(servers: tuple) -> str:
+    """Picks the backend for the next request according to LB_POLICY."""
+    global next_server_index
+    if LB_POLICY == "least":
+        return min(servers, key=inflight_requests.__getitem__)
+
+    # Round-robin over the current snapshot. The modulo keeps the index valid
+    # if the healthy set shrank since the last request.
+    index = next_server_index % len(servers)
+    next_server_index = index + 1
+    return servers[index]
+
+# --- Request/Response Streaming ---
+async def stream_client_body(request: Request):
+    """
+    Yields the client request body as it arrives so it can be forwarded to
+    the backend without first being buffered in the load balancer. Reads
+    straight from the ASGI receive channel, handing each chunk to aiohttp
+    exactly as the server delivered it.
+    """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnect()
+        body = message.get("body", b"")
+        if body:
+            yield body
+        if not message.get("more_body", False):
+            break
+
+async def stream_backend_response(response: aiohttp.ClientResponse, server: str):
+    """
+    Yields the backend response body as it arrives and releases the
+    connection back to the pool once the body is exhausted or the client
+    goes away. The request stops counting as in flight at the same point.
+    """
+    try:
+        async for chunk in response.content.iter_any():
+            yield chunk
+    finally:
+        response.release()
+        inflight_requests[server] -= 1
+
+# --- Final Proxy Logic (Streaming Proxy) ---
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
 async def proxy(request: Request, path: str):
     """
-    Catches all incoming requests, forwards them, waits for the full response,
-    and then forwards that full response back to the client.
+    Catches all incoming requests, forwards them, and streams the backend
+    response back to the client as it is received.
     """
-    if not healthy_servers:
+    servers = healthy_servers
+    if not servers:
         raise HTTPException(status_code=503, detail="No healthy backend servers available.")
 
-    target_server = next(server_iterator)
-    print(f"Forwarding request to {target_server}")
+    target_server = select_server(servers)
+    client = request.app.state.client
+    if logger.isEnabledFor(logging.DEBUG):
+        # Report pool usage so it is visible when the connector limit is reached.
+        logger.debug(
+            "Forwarding request to %s (connections in use: %d/%d)",
+            target_server, len(client.connector._acquired), CONNECTOR_LIMIT,
+        )
     
     url = f"{target_server}/{path}"
     
+    # Recreate headers, excluding hop-by-hop headers. Content-Length is kept
+    # so the streamed body is not re-framed with chunked encoding. ASGI
+    # servers already deliver raw header names in lowercase.
+    backend_headers = [
+        (k.decode("latin-1"), v.decode("latin-1"))
+        for k, v in request.headers.raw
+        if k.decode("latin-1") not in HOP_BY_HOP_HEADERS
+    ]
+
+    # Only stream a body upstream if the client actually sent one.
+    has_body = (
+        request.headers.get("content-length", "0") != "0"
+        or "transfer-encoding" in request.headers
+    )
+
+    inflight_requests[target_server] += 1
     try:
-        async with aiohttp.ClientSession() as session:
-            # Recreate headers, excluding the Host header
-            backend_headers = {k: v for k, v in request.headers.items() if k.lower() != 'host'}
-            
-            async with session.request(
-                method=request.method,
-                url=url,
-                headers=backend_headers,
-                params=request.query_params,
-                data=await request.body(),
-                timeout=aiohttp.ClientTimeout(total=120.0)
-            ) as response:
-                
-                # Read the entire response body from the backend server.
-                content = await response.read()
-
-                # Filter hop-by-hop headers that shouldn't be forwarded.
-                response_headers = {
-                    k: v for k, v in response.headers.items()
-                    if k.lower() not in ("transfer-encoding", "connection")
-                }
-                
-                # Return a standard FastAPI Response with the full content.
-                return Response(
-                    content=content,
-                    status_code=response.status,
-                    headers=response_headers,
-                )
+        # Reuse the shared session so the backend connection is pooled. The
+        # response is not used as a context manager here: it must stay open
+        # while the body is streamed, and is released by the body generator.
+        response = await client.request(
+            method=request.method,
+            url=url,
+            headers=backend_headers,
+            params=request.query_params,
+            data=stream_client_body(request) if has_body else None,
+            timeout=PROXY_TIMEOUT,
+            # Relay redirects to the client rather than following them: a
+            # proxy should not, and a streamed body cannot be replayed.
+            allow_redirects=False,
+        )
     except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        inflight_requests[target_server] -= 1
         raise HTTPException(status_code=502, detail=f"Bad Gateway or connection error: {e}")
+    except BaseException:
+        # e.g. the client disconnected while its body was being forwarded.
+        inflight_requests[target_server] -= 1
+        raise
+
+    # Filter hop-by-hop headers that shouldn't be forwarded.
+    response_headers = {
+        k: v for k, v in response.headers.items()
+        if k.lower() not in HOP_BY_HOP_HEADERS
+    }
+
+    # Stream the body through instead of buffering it in the load balancer.
+    return StreamingResponse(
+        stream_backend_response(response, target_server),
+        status_code=response.status,
+        headers=response_headers,
+        media_type=response.headers.get("content-type"),
+    )
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    # The load balancer holds no GPU state, so it scales across CPU cores.
+    # Each worker runs its own health checks and round-robin position. The
+    # "least" policy needs one view of every in-flight request, which only a
+    # single process has, so it always runs as one worker.
+    # uvloop is not available on Windows, where the default asyncio loop is used.
+    uvicorn.run(
+        "load_balancer:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "5000")),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=1 if LB_POLICY == "least" else os.cpu_count() or 1,
+    )
@@ -1,14 +1,22 @@
 # Synapse - The main LLM Server Application
 import os
+import sys
+import copy
+import asyncio
+import uvicorn
 import torch
 import time
+import msgspec
 from pathlib import Path
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
+from collections import OrderedDict
+from jinja2 import TemplateError
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from synapse_logging import get_logger
 
 # --- Explicitly load the .env file from the script's directory ---
 # This makes the script independent of the current working directory.
@@ -19,75 +27,391 @@ load_dotenv(dotenv_path=dotenv_path)
 # The MODEL_NAME is now reliably loaded from the .env file.
 MODEL_NAME = os.environ.get("MODEL_NAME", "gpt2")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Half-precision weights halve the memory read per generated token on GPU.
+# CPUs keep float32, where half-precision matmuls are typically slower.
+if DEVICE == "cuda":
+    TORCH_DTYPE = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+else:
+    TORCH_DTYPE = torch.float32
+# Optional weight quantization via bitsandbytes (CUDA only): "nf4", "int8"
+# or "none". Fewer bytes per weight means faster memory-bound decoding.
+QUANT = os.environ.get("QUANT", "none").lower()
+# Requests arriving close together are coalesced into a single padded batch.
+# MAX_BATCH_SIZE bounds GPU memory; MAX_BATCH_WAIT_MS bounds the extra latency
+# a request can pick up while waiting for others to join its batch.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+MAX_BATCH_WAIT_MS = int(os.environ.get("MAX_BATCH_WAIT_MS", "5"))
+# Number of conversation prefixes (system prompt plus history) whose KV cache
+# is kept on the device, so repeat prefixes skip their prefill. 0 disables it.
+PREFIX_CACHE_SIZE = int(os.environ.get("PREFIX_CACHE_SIZE", "16"))
+# Number of recently seen prefixes remembered so that only prefixes seen a
+# second time get cached; conversation-specific history is rarely repeated.
+PREFIX_SEEN_SIZE = 8 * PREFIX_CACHE_SIZE
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# --- Logging ---
+logger = get_logger("synapse.server", LOG_LEVEL)
 
 # --- Global Variables ---
 model = None
 tokenizer = None
+# Tokenizer properties looked up on every request, cached once at load time.
+pad_token_id = None
+has_chat_template = False
+# Maps rendered prefix text to its token ids and precomputed KV cache, least
+# recently used first, plus the prefixes seen recently but not yet cached.
+prefix_cache: "OrderedDict[str, Tuple[torch.Tensor, DynamicCache]]" = OrderedDict()
+prefix_seen: "OrderedDict[str, None]" = OrderedDict()
+generation_queue: "asyncio.Queue[PendingGeneration]" = asyncio.Queue()
+
+# --- Model Loading ---
+def quantization_config() -> Optional[BitsAndBytesConfig]:
+    """Builds the bitsandbytes config selected by QUANT, if any."""
+    if QUANT == "none":
+        return None
+    if QUANT == "nf4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=TORCH_DTYPE,
+            bnb_4bit_use_double_quant=True,
+        )
+    if QUANT == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    raise ValueError(f"Unsupported QUANT value: {QUANT!r} (expected nf4, int8 or none)")
+
+def load_model():
+    """
+    Loads the model in TORCH_DTYPE, quantized if QUANT is set. Quantized
+    models are placed on the device by from_pretrained and cannot be moved.
+    """
+    bnb_config = quantization_config()
+    if bnb_config is None:
+        return AutoModelForCausalLM.from_pretrained(
+            MODEL_NAME, dtype=TORCH_DTYPE, low_cpu_mem_usage=True
+        ).to(DEVICE).eval() # type: ignore
+    return AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        dtype=TORCH_DTYPE,
+        quantization_config=bnb_config,
+        device_map=DEVICE,
+        low_cpu_mem_usage=True,
+    ).eval()
 
 # --- Lifespan Event Handler ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model, tokenizer
-    print("--- Starting Synapse LLM Server Node ---")
-    print(f"Loading model: {MODEL_NAME} on device: {DEVICE}")
+    global model, tokenizer, pad_token_id, has_chat_template
+    logger.info("--- Starting Synapse LLM Server Node ---")
+    logger.info(
+        "Loading model: %s on device: %s (%s, quantization: %s)",
+        MODEL_NAME, DEVICE, TORCH_DTYPE, QUANT,
+    )
     try:
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        model = AutoModelForCausalLM.from_pretrained(MODEL_NAME).to(DEVICE) # type: ignore
-        print("Model and tokenizer loaded successfully.")
+        # Prefer the Rust-backed "fast" tokenizer where the model provides one.
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_fast=True)
+        # Decoder-only models must be padded on the left for batched
+        # generation; models like gpt2 have no pad token, so reuse EOS.
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        pad_token_id = tokenizer.pad_token_id
+        has_chat_template = tokenizer.chat_template is not None
+        model = load_model()
+        # Cached KV states are only valid for the model that produced them.
+        prefix_cache.clear()
+        prefix_seen.clear()
+        logger.info("Model and tokenizer loaded successfully.")
     except Exception as e:
-        print(f"Error loading model: {e}")
+        logger.error("Error loading model: %s", e)
         raise e
+
+    batcher = asyncio.create_task(batch_worker())
     
     yield
     
-    print("--- Shutting down Synapse LLM Server Node ---")
+    logger.info("--- Shutting down Synapse LLM Server Node ---")
+    batcher.cancel()
 
 # --- FastAPI Application ---
 app = FastAPI(title="Synapse - LLM Server", lifespan=lifespan)
 
-# --- Pydantic Models ---
-class Message(BaseModel):
+# --- msgspec Models ---
+# msgspec decodes and validates JSON straight into these structs in C, which
+# is considerably cheaper per request than building Pydantic models.
+class Message(msgspec.Struct):
     role: str
     content: str
 
-class ChatCompletionRequest(BaseModel):
+class ChatCompletionRequest(msgspec.Struct):
     model: str
     messages: List[Message]
     max_tokens: Optional[int] = 512
     temperature: Optional[float] = 0.7
 
-class ChatCompletionChoice(BaseModel):
+class ChatCompletionChoice(msgspec.Struct):
     index: int
     message: Message
     finish_reason: str
 
-class ChatCompletionResponse(BaseModel):
+class ChatCompletionResponse(msgspec.Struct):
     id: str
     object: str
     created: int
     model: str
     choices: List[ChatCompletionChoice]
 
+# --- Generation ---
+def build_prompt(messages: List[Message]) -> str:
+    """
+    Renders the whole conversation with the model's chat template, ending
+    with the assistant generation prompt. Models without a chat template
+    (such as gpt2) fall back to the content of the last message.
+    """
+    if not has_chat_template:
+        return messages[-1].content
+    return tokenizer.apply_chat_template( # type: ignore
+        [msgspec.structs.asdict(m) for m in messages],
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+def build_prefixes(messages: List[Message], prompt: str) -> Tuple[str, ...]:
+    """
+    Renders the conversation at every message boundary before the last
+    message, longest first, for use as prefix cache keys. The shortest is
+    the first message alone, typically the shared system prompt. Renderings
+    that the template rejects or that are not an exact text prefix of the
+    full prompt are left out.
+    """
+    if not has_chat_template or PREFIX_CACHE_SIZE <= 0 or len(messages) < 2:
+        return ()
+    conversation = [msgspec.structs.asdict(m) for m in messages]
+    prefixes = []
+    for end in range(len(conversation) - 1, 0, -1):
+        try:
+            prefix = tokenizer.apply_chat_template(conversation[:end], tokenize=False) # type: ignore
+        except TemplateError:
+            # e.g. templates that require the conversation to end on a user turn.
+            continue
+        if prompt.startswith(prefix):
+            prefixes.append(prefix)
+    return tuple(prefixes)
+
+class PendingGeneration(NamedTuple):
+    prompt: str
+    prefixes: Tuple[str, ...]
+    max_tokens: Optional[int]
+    temperature: Optional[float]
+    future: "asyncio.Future[str]"
+
+def generate_batch(prompts: List[str], max_tokens: Optional[int], temperature: Optional[float]) -> List[str]:
+    """
+    Tokenizes the prompts as one padded batch, runs a single model.generate
+    call and decodes only the newly generated tokens of each row. This blocks
+    for the whole generation, so it must be run off the event loop.
+    """
+    with torch.inference_mode():
+        # Chat templates already insert any special tokens the model expects.
+        inputs = tokenizer( # type: ignore
+            prompts,
+            padding=True,
+            add_special_tokens=not has_chat_template,
+            return_tensors="pt",
+        ).to(DEVICE)
+        outputs = model.generate( # type: ignore
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            max_new_tokens=max_tokens,
+            temperature=temperature,
+            use_cache=True,
+            pad_token_id=pad_token_id
+        )
+        # Prompts are left-padded to the same length, so the completion of
+        # every row starts at the same column.
+        prompt_length = inputs["input_ids"].shape[1]
+        return tokenizer.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True) # type: ignore
+
+def is_token_prefix(prefix_ids: torch.Tensor, input_ids: torch.Tensor) -> bool:
+    """Checks that prefix_ids is a strict prefix of input_ids (both [1, L], on CPU)."""
+    length = prefix_ids.shape[1]
+    return input_ids.shape[1] > length and torch.equal(input_ids[0, :length], prefix_ids[0])
+
+def get_prefix_cache(prefixes: Tuple[str, ...], input_ids: torch.Tensor) -> Optional[DynamicCache]:
+    """
+    Returns the KV cache for the longest usable prefix of the prompt, or None
+    if there is none. A prefix is only prefilled and cached once it has been
+    seen before, and then by extending the longest cached prefix it starts
+    with. Evicts the least recently used entry once PREFIX_CACHE_SIZE is
+    exceeded. The returned cache is shared and must be copied before use.
+    """
+    cached = None
+    candidate = None
+    for prefix in prefixes:
+        entry = prefix_cache.get(prefix)
+        if entry is not None and is_token_prefix(entry[0], input_ids):
+            cached = prefix
+            break
+        if candidate is None and entry is None and prefix in prefix_seen:
+            candidate = prefix
+
+    # Record every boundary of this prompt as seen, and keep cached shared
+    # prefixes such as the system prompt ahead of single-conversation ones.
+    for prefix in prefixes:
+        if prefix in prefix_cache:
+            prefix_cache.move_to_end(prefix)
+        else:
+            prefix_seen[prefix] = None
+            prefix_seen.move_to_end(prefix)
+    while len(prefix_seen) > PREFIX_SEEN_SIZE:
+        prefix_seen.popitem(last=False)
+
+    if candidate is None:
+        return prefix_cache[cached][1] if cached is not None else None
+
+    candidate_ids = tokenizer(candidate, add_special_tokens=False, return_tensors="pt")["input_ids"] # type: ignore
+    if not is_token_prefix(candidate_ids, input_ids):
+        return prefix_cache[cached][1] if cached is not None else None
+
+    # Only prefill the part of the candidate not already covered by the
+    # cached prefix. logits_to_keep=1 avoids materializing [1, L, vocab]
+    # logits that are never used.
+    cache = DynamicCache()
+    start = 0
+    if cached is not None:
+        cached_ids, cached_cache = prefix_cache[cached]
+        if is_token_prefix(cached_ids, candidate_ids):
+            cache = copy.deepcopy(cached_cache)
+            start = cached_ids.shape[1]
+    model( # type: ignore
+        input_ids=candidate_ids[:, start:].to(DEVICE),
+        past_key_values=cache,
+        use_cache=True,
+        logits_to_keep=1,
+    )
+
+    del prefix_seen[candidate]
+    prefix_cache[candidate] = (candidate_ids, cache)
+    if len(prefix_cache) > PREFIX_CACHE_SIZE:
+        prefix_cache.popitem(last=False)
+    return cache
+
+def generate_with_prefix_cache(prompt: str, prefixes: Tuple[str, ...], max_tokens: Optional[int], temperature: Optional[float]) -> str:
+    """
+    Generates a single completion, reusing the cached KV states of the
+    longest known conversation prefix so only the rest of the prompt has to
+    be prefilled. Falls back to generate_batch when no prefix is cached.
+    """
+    with torch.inference_mode():
+        input_ids = tokenizer(prompt, add_special_tokens=False, return_tensors="pt")["input_ids"] # type: ignore
+        prefix_cache_entry = get_prefix_cache(prefixes, input_ids)
+        if prefix_cache_entry is None:
+            return generate_batch([prompt], max_tokens, temperature)[0]
+
+        input_ids = input_ids.to(DEVICE)
+        # generate extends the cache in place, so work on a copy.
+        past_key_values = copy.deepcopy(prefix_cache_entry)
+        # The full prompt is passed; generate skips the positions already
+        # covered by the cache.
+        outputs = model.generate( # type: ignore
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            max_new_tokens=max_tokens,
+            temperature=temperature,
+            use_cache=True,
+            pad_token_id=pad_token_id
+        )
+        return tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True) # type: ignore
+
+async def collect_batch() -> List[PendingGeneration]:
+    """
+    Waits for the next request, then gathers any others that arrive within
+    MAX_BATCH_WAIT_MS, up to MAX_BATCH_SIZE in total.
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await generation_queue.get()]
+    deadline = loop.time() + MAX_BATCH_WAIT_MS / 1000
+    while len(batch) < MAX_BATCH_SIZE:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(generation_queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def batch_worker():
+    """
+    Background task that drains the generation queue in batches. Requests
+    are grouped by their sampling parameters, since a single generate call
+    applies the same settings to every row. Only one batch runs on the model
+    at a time; requests arriving meanwhile form the next batch.
+
+    A request that ends up alone in its group goes through the prefix cache
+    when it has a conversation prefix. Padded batches cannot share a cached
+    prefix, so larger groups always prefill from scratch.
+    """
+    while True:
+        batch = await collect_batch()
+
+        groups: dict = {}
+        for item in batch:
+            groups.setdefault((item.max_tokens, item.temperature), []).append(item)
+
+        for (max_tokens, temperature), items in groups.items():
+            try:
+                if len(items) == 1 and items[0].prefixes:
+                    texts = [await asyncio.to_thread(
+                        generate_with_prefix_cache, items[0].prompt, items[0].prefixes, max_tokens, temperature
+                    )]
+                else:
+                    texts = await asyncio.to_thread(
+                        generate_batch, [item.prompt for item in items], max_tokens, temperature
+                    )
+            except Exception as e:
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+
+            for item, text in zip(items, texts):
+                if not item.future.done():
+                    item.future.set_result(text)
+
 # --- API Endpoints ---
 @app.get("/health")
-async def health_check():
+async def health_check() -> Dict[str, str]:
     return {"status": "ok"}
 
-@app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
-async def create_chat_completion(request: ChatCompletionRequest):
+@app.post("/v1/chat/completions")
+async def create_chat_completion(raw_request: Request):
     if not model or not tokenizer:
         raise HTTPException(status_code=503, detail="Model not loaded")
 
-    prompt = request.messages[-1].content
+    try:
+        request = msgspec.json.decode(await raw_request.body(), type=ChatCompletionRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not request.messages:
+        raise HTTPException(status_code=422, detail="messages must not be empty")
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=request.max_tokens,
-        temperature=request.temperature,
-        pad_token_id=tokenizer.eos_token_id
+    prompt = build_prompt(request.messages)
+
+    # Hand the prompt to the batch worker, which runs generation in a worker
+    # thread so the event loop keeps serving other requests in the meantime.
+    future = asyncio.get_running_loop().create_future()
+    await generation_queue.put(
+        PendingGeneration(
+            prompt,
+            build_prefixes(request.messages, prompt),
+            request.max_tokens,
+            request.temperature,
+            future,
+        )
     )
-    response_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    response_text = await future
 
     response = ChatCompletionResponse(
         id="chatcmpl-123",
@@ -102,10 +426,10 @@ async def create_chat_completion(request: ChatCompletionRequest):
             )
         ]
     )
-    return response
+    return Response(content=msgspec.json.encode(response), media_type="application/json")
 
 @app.get("/v1/models")
-async def list_models():
+async def list_models() -> Dict[str, Any]:
     return {
         "object": "list",
         "data": [
@@ -116,4 +440,17 @@ async def list_models():
                 "permission": []
             }
         ]
-    }
\ No newline at end of file
+    }
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    # A node owns the GPU, so it always runs as a single worker process.
+    # uvloop is not available on Windows, where the default asyncio loop is used.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=1,
+    )
@@ -0,0 +1,31 @@
+# Synapse - Logging
+# Shared logging setup for the LLM server nodes and the load balancer.
+# Records are handed to a queue and written to stderr by a listener thread,
+# so formatting and console I/O never block the event loop.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+def get_logger(name: str, level: str) -> logging.Logger:
+    """
+    Returns the named logger, attaching a queue handler and starting its
+    listener thread the first time it is requested. Later calls, such as
+    when uvicorn or a worker process imports the module a second time,
+    reuse the existing handler instead of adding another one.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if logger.handlers:
+        return logger
+
+    logger.propagate = False
+    log_queue: queue.Queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    return logger